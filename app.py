@@ -1,6 +1,10 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import os
+from datetime import datetime, timedelta, timezone
+
+JST = timezone(timedelta(hours=9))
 
 # -------------------------------------------
 # 1. ページ設定
@@ -18,21 +22,43 @@ def check_password():
 if not check_password(): st.stop()
 
 # -------------------------------------------
-# 2. データ読み込み (CSVから)
+# 2. データ読み込み (Parquetから。無ければCSV)
 # -------------------------------------------
-@st.cache_data(ttl=300)
-def load_data_from_csv():
-    file_path = "data/engagement.csv"
-    if not os.path.exists(file_path):
+PARQUET_PATH = "data/engagement.parquet"
+CSV_PATH = "data/engagement.csv"
+
+# アプリで使う列 (不要な列は読まない)
+# ※件数列は型を固定しない。空欄があっても読み込みを失敗させず、スコア計算側で0埋めする
+DATA_COLUMNS = ["Email", "User", "Role", "Avatar", "Slack Count", "Linear Count", "Working Hours"]
+# 値の種類が少ない文字列列はカテゴリ型にしてメモリとソートを軽くする
+CATEGORY_DTYPES = {"Role": "category", "User": "category"}
+
+def get_data_path():
+    return PARQUET_PATH if os.path.exists(PARQUET_PATH) else CSV_PATH
+
+# 全セッションで1つのDataFrameを共有する (読み取り専用として扱うこと)
+# ファイルの更新時刻をキーにしているので、update_data.py が書き換えると自動で読み直す
+@st.cache_resource(max_entries=1)
+def load_shared_data(file_path, mtime_ns):
+    if file_path == PARQUET_PATH:
+        df = pd.read_parquet(file_path, columns=DATA_COLUMNS)
+    else:
+        df = pd.read_csv(file_path, engine="pyarrow", usecols=DATA_COLUMNS)
+    return df.astype(CATEGORY_DTYPES)
+
+def load_data():
+    file_path = get_data_path()
+    try:
+        mtime_ns = os.stat(file_path).st_mtime_ns
+    except FileNotFoundError:
         return pd.DataFrame()
     try:
-        df = pd.read_csv(file_path)
-        return df
+        return load_shared_data(file_path, mtime_ns)
     except Exception as e:
-        st.error(f"Error loading CSV: {e}")
+        st.error(f"Error loading data: {e}")
         return pd.DataFrame()
 
-df_raw = load_data_from_csv()
+df_raw = load_data()
 
 # -------------------------------------------
 # 3. サイドバー設定
@@ -40,15 +66,15 @@ df_raw = load_data_from_csv()
 st.sidebar.header("⚙️ 設定")
 
 if df_raw.empty:
-    st.warning("データファイル (data/engagement.csv) が見つかりません。")
+    st.warning(f"データファイル ({get_data_path()}) を読み込めません。")
     st.stop()
 
 # 更新日時
 try:
-    file_stat = os.stat("data/engagement.csv")
-    last_updated = pd.to_datetime(file_stat.st_mtime, unit='s') + pd.Timedelta(hours=9)
+    file_stat = os.stat(get_data_path())
+    last_updated = datetime.fromtimestamp(file_stat.st_mtime, JST)
     st.sidebar.caption(f"最終更新: {last_updated.strftime('%Y-%m-%d %H:%M')}")
-except:
+except OSError:
     pass
 
 st.sidebar.subheader("⚖️ スコアの重み付け")
@@ -58,20 +84,56 @@ w_linear = st.sidebar.slider("Linear (1完了あたり)", 0.5, 5.0, 1.0, 0.1)
 # -------------------------------------------
 # 4. スコア計算
 # -------------------------------------------
-df_calc = df_raw.copy()
-
-# NaN埋め（エラー防止）
-df_calc["Slack Count"] = df_calc["Slack Count"].fillna(0)
-df_calc["Linear Count"] = df_calc["Linear Count"].fillna(0)
+# ランキング表に表示する上位人数 (全件ソートを避け、上位だけを選択する)
+# 意図的な上限: これを超えるメンバーは表に出さず、画面にその旨を表示する
+RANKING_TOP_K = 100
+
+# スライダー操作のたびにスクリプト全体が再実行されるため、
+# 重みの組み合わせごとに計算結果をキャッシュする
+@st.cache_data(max_entries=500)
+def compute_scores(df_raw, w_slack, w_linear):
+    """重み付けスコアを計算し、(ランキング表, グラフ用データ, スコア発生人数) を返す"""
+    # NaN埋め（エラー防止）
+    slack_count = df_raw["Slack Count"].fillna(0).to_numpy()
+    linear_count = df_raw["Linear Count"].fillna(0).to_numpy()
+    hours = df_raw["Working Hours"].to_numpy()
+
+    # pandasのインデックス整列を避け、NumPy配列で一括計算する
+    slack = slack_count * w_slack
+    linear = linear_count * w_linear
+    total = slack + linear
+
+    # df_raw は全セッション共有なので変更もコピーもせず、必要な列だけを新しい表に組み立てる
+    df_calc = pd.concat([
+        df_raw[["User", "Role"]],
+        pd.DataFrame({
+            "Slack Count": slack_count,
+            "Linear Count": linear_count,
+            "Slack Score": slack,
+            "Linear Score": linear,
+            "Total Score": total,
+            "Productivity": total / np.where(hours == 0, 1, hours),
+        }, index=df_raw.index),
+    ], axis=1)
+
+    # ランキング順に上位K人を選択 (K人に満たない間はスコア0の人も含めて全員)
+    k = min(RANKING_TOP_K, len(df_calc))
+    df_ranked = df_calc.nlargest(k, "Total Score").reset_index(drop=True)
+    df_ranked.index += 1
 
-df_calc["Slack Score"] = df_calc["Slack Count"] * w_slack
-df_calc["Linear Score"] = df_calc["Linear Count"] * w_linear
-df_calc["Total Score"] = df_calc["Slack Score"] + df_calc["Linear Score"]
-df_calc["Productivity"] = df_calc["Total Score"] / df_calc["Working Hours"].replace(0, 1)
-
-# ランキング順にソート (スコア0の人も含む)
-df_ranked = df_calc.sort_values("Total Score", ascending=False).reset_index(drop=True)
-df_ranked.index += 1
+    # グラフ用にデータを整形
+    # 上位K人に絞ることでブラウザへ渡すデータ量を最大 2K 行に抑える
+    # (0点の行も残し、軸上の枠を確保する。melt と同じ縦持ち形式を tile/repeat で直接組み立てる)
+    n = len(df_ranked)
+    df_chart = pd.DataFrame({
+        "User": np.tile(df_ranked["User"].to_numpy(), 2),
+        "Type": np.repeat(["Slack Score", "Linear Score"], n),
+        "Score": np.concatenate([df_ranked["Slack Score"].to_numpy(), df_ranked["Linear Score"].to_numpy()]),
+    })
+    active_members = int(np.count_nonzero(total > 0))
+    return df_ranked, df_chart, active_members
+
+df_ranked, df_chart, active_members = compute_scores(df_raw, w_slack, w_linear)
 
 # -------------------------------------------
 # 5. 可視化 (Dashboard)
@@ -79,38 +141,54 @@ df_ranked.index += 1
 st.title("📊 Team Engagement Graph")
 
 # ★追加: 集計ステータスの表示
-total_members = len(df_ranked)
-active_members = len(df_ranked[df_ranked["Total Score"] > 0])
+total_members = len(df_raw)
 st.markdown(f"**集計対象: {total_members} 名** (うちスコア発生: {active_members} 名)")
 
+# 積み上げ棒グラフの Vega-Lite 定義
+# (st.bar_chart 経由の Altair オブジェクト生成を避け、仕様を直接渡す。
+#  見た目は st.bar_chart が生成していた仕様に合わせる)
+CHART_SPEC = {
+    "mark": "bar",
+    "encoding": {
+        "x": {"field": "User", "type": "ordinal", "axis": {"grid": False}},
+        "y": {"field": "Score", "type": "quantitative", "stack": "zero", "axis": {"grid": True}},
+        "color": {
+            "field": "Type",
+            "type": "nominal",
+            "legend": {"orient": "bottom", "titlePadding": 5, "offset": 5},
+        },
+        "tooltip": [
+            {"field": "User", "type": "nominal"},
+            {"field": "Score", "type": "quantitative", "format": ".1f"},
+            {"field": "Type", "type": "nominal"},
+        ],
+    },
+    # st.bar_chart と同じくドラッグ/ホイールで拡大・移動できるようにする
+    "params": [{"name": "zoom", "select": {"type": "interval", "encodings": ["x", "y"]}, "bind": "scales"}],
+}
+
 col1, col2 = st.columns([1, 1])
 
 with col1:
     st.subheader("📈 Engagement 内訳")
     
-    # グラフ用にデータを整形
-    df_chart = df_ranked[["User", "Slack Score", "Linear Score"]].melt(
-        id_vars="User", var_name="Type", value_name="Score"
-    )
-    
-    # 棒グラフ (全員を表示するために高さ制限を外す等の工夫は難しいが、データは渡す)
-    # ※Streamlitの仕様上、0点のデータは棒が表示されませんが、スペースは確保されます
-    st.bar_chart(
-        df_chart,
-        x="User",
-        y="Score",
-        color="Type",
-        stack=True
-    )
+    # 棒グラフ (ランキング上位K人)
+    # ※0点のデータは棒が表示されませんが、スペースは確保されます
+    st.vega_lite_chart(df_chart, CHART_SPEC, width="stretch")
     
     st.info("※ 棒グラフはスコアが 0 のメンバーは表示されません。")
 
 with col2:
     st.subheader("🏆 ランキング表")
+    if total_members > len(df_ranked):
+        st.caption(f"※ 上位 {len(df_ranked)} 名のみ表示 (全 {total_members} 名)")
     
     potential_cols = ["User", "Role", "Total Score", "Slack Count", "Linear Count"]
     display_cols = [c for c in potential_cols if c in df_ranked.columns]
     
+    # ランキング表は降順なので、先頭の値がそのまま最大値になる
+    max_score = float(df_ranked["Total Score"].iat[0]) * 1.1 if len(df_ranked) else 1.0
+    
     # ★変更点: height=800 を指定して、縦に長く表示する (スクロール減らす)
     st.dataframe(
         df_ranked[display_cols],
@@ -122,7 +200,7 @@ with col2:
                 "Score",
                 format="%.1f",
                 min_value=0,
-                max_value=float(df_ranked["Total Score"].max()) * 1.1,
+                max_value=max_score,
             ),
         }
     )
@@ -1,11 +1,133 @@
 import os
+import json
 import time
+import functools
+import hashlib
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_handlers import (
+    ConnectionErrorRetryHandler,
+    RateLimitErrorRetryHandler,
+)
 from datetime import datetime, timedelta
 
+# Slack クライアント (429 は Retry-After に従って SDK が自動で再試行する)
+def _slack_client(token):
+    return WebClient(
+        token=token,
+        retry_handlers=[
+            ConnectionErrorRetryHandler(),
+            RateLimitErrorRetryHandler(max_retry_count=5),
+        ],
+    )
+
+# Linear API 用のセッション (TLS接続を使い回し、一時的なエラーは自動で再試行)
+# GraphQL のクエリは冪等なので POST も再試行対象にする
+_linear_session = requests.Session()
+_linear_session.mount("https://", HTTPAdapter(max_retries=Retry(
+    total=5,
+    backoff_factor=0.5,
+    status_forcelist=[429, 502, 503, 504],
+    allowed_methods=["POST"],
+    raise_on_status=False,
+)))
+
+# スレッド返信の並列取得設定
+# conversations.replies は Tier 3 (約50回/分)。取得ペースを決めるのはワーカー数ではなく、
+# この上限から決めた全ワーカー共通の呼び出し間隔 (_SlackThrottle)。
+# 1往復は間隔 (1.2秒) より短いので、待ち時間を重ねるには2ワーカーで十分
+SLACK_THREAD_WORKERS = 2
+SLACK_REPLIES_PER_MINUTE = 50
+SLACK_MIN_INTERVAL = 60 / SLACK_REPLIES_PER_MINUTE  # 全ワーカー合計での最小呼び出し間隔 (秒)
+
+class _SlackThrottle:
+    """全ワーカーで共有する呼び出し間隔の制御 (スレッドセーフ)"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_for = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+    def backoff(self, seconds):
+        """429 を受けたとき、全ワーカーの次の呼び出しをまとめて後ろにずらす"""
+        with self.lock:
+            self.next_at = max(self.next_at, time.monotonic() + seconds)
+
+def _retry_after(error):
+    """SlackApiError の Retry-After ヘッダ (秒) を取り出す"""
+    for k, v in error.response.headers.items():
+        if k.lower() == "retry-after":
+            return int(v[0] if isinstance(v, list) else v)
+    return 1
+
+def _fetch_thread_replies(client, throttle, channel_id, thread_ts, oldest, latest):
+    """1スレッド分の返信を取得する"""
+    throttle.wait()
+    resp = client.conversations_replies(
+        channel=channel_id,
+        ts=thread_ts,
+        limit=1000,
+        oldest=oldest, # 期間内の返信のみ対象にする
+        latest=latest
+    )
+    return resp["messages"]
+
+# users.list のキャッシュ (名簿取得と集計の両方で使うため1回の取得で済ませる)
+USERS_CACHE_PATH = "data/.users_cache.json"
+USERS_CACHE_TTL = 24 * 60 * 60  # 秒
+
+_users_list_lock = threading.Lock()
+
+def _get_users_list(token):
+    """users.list の全ページを取得する。プロセス内とディスクの両方にキャッシュする"""
+    # 名簿取得と集計が並列に呼ぶため、最初の1回だけがAPIを叩くようにロックする
+    with _users_list_lock:
+        return _load_users_list(token)
+
+@functools.lru_cache(maxsize=1)
+def _load_users_list(token):
+    # トークン (=ワークスペース) が変わったら別の名簿を使わないよう、ハッシュを一緒に保存する
+    token_hash = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    try:
+        with open(USERS_CACHE_PATH, encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached["token_hash"] == token_hash and time.time() - cached["ts"] < USERS_CACHE_TTL:
+            return cached["members"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    client = _slack_client(token)
+    members = []
+    for page in client.users_list(limit=200):
+        members.extend(page["members"])
+
+    # キャッシュの保存は失敗しても集計は続ける
+    try:
+        os.makedirs("data", exist_ok=True)
+        with open(USERS_CACHE_PATH, "w", encoding="utf-8") as f:
+            json.dump(
+                {"ts": time.time(), "token_hash": token_hash, "members": members},
+                f, ensure_ascii=False
+            )
+    except OSError as e:
+        print(f"Users cache write warning: {e}")
+    return members
+
 # ------------------------------------------------------------------
 # 1. Slackから「名簿」を作る関数
 # ------------------------------------------------------------------
@@ -15,15 +137,14 @@ def fetch_slack_user_directory():
         print("Skipping Slack directory: Token missing.")
         return {}
 
-    client = WebClient(token=token)
     try:
-        users_resp = client.users_list()
+        members = _get_users_list(token)
     except SlackApiError as e:
         print(f"Error fetching users: {e}")
         return {}
 
     directory = {}
-    for u in users_resp["members"]:
+    for u in members:
         if u["is_bot"] or u["deleted"] or "profile" not in u:
             continue
         email = u["profile"].get("email")
@@ -50,81 +171,122 @@ def fetch_slack_data(start_date, end_date):
         print("Token or Channel ID missing.")
         return pd.DataFrame(columns=["Email", "Slack Count"])
 
-    client = WebClient(token=token)
+    client = _slack_client(token)
     oldest = start_date.timestamp()
     latest = end_date.timestamp()
     
     try:
         # A. ユーザーID対応表
-        users_resp = client.users_list()
         uid_to_email = {}
-        for u in users_resp["members"]:
+        for u in _get_users_list(token):
             if "profile" in u and "email" in u["profile"]:
                 uid_to_email[u["id"]] = u["profile"]["email"]
 
         # B. 親メッセージ履歴取得
-        # ※直近30日間の親メッセージを取得
-        history = client.conversations_history(
+        # ※直近30日間の親メッセージを取得 (カーソルで全ページを取得)
+        messages = []
+        for page in client.conversations_history(
             channel=channel_id, 
             oldest=oldest, 
             latest=latest,
-            limit=1000
-        )
+            limit=200
+        ):
+            messages.extend(page["messages"])
         
-        messages = history["messages"]
         print(f"Found {len(messages)} parent messages. Analyzing threads...")
         
-        counts = {} 
-        
         # C. メッセージを走査
-        for i, msg in enumerate(messages):
-            # システムメッセージやBot除外
-            if "subtype" in msg or "bot_id" in msg:
+        # システムメッセージやBot除外 (ページ間で重複したメッセージは ts で1つにまとめる)
+        parents = list({
+            m["ts"]: m for m in messages if "subtype" not in m and "bot_id" not in m
+        }.values())
+
+        # --- 1. 親メッセージのカウント ---
+        # ホットループ内の辞書参照は get をローカルに束縛して1回で済ませる
+        # (未登録ユーザーは None になるので filter で除外)
+        get_email = uid_to_email.get
+        counts = Counter(filter(None, (get_email(m.get("user")) for m in parents)))
+
+        # thread_ts があり、かつ返信数が1以上のもの (同じスレッドは thread_ts で1つにまとめる)
+        thread_parents = {
+            m["thread_ts"]: m for m in parents
+            if "thread_ts" in m and m.get("reply_count", 0) > 0
+        }
+
+        threaded = []
+        for msg in thread_parents.values():
+            # 返信者が全員1回ずつしか返信していないスレッドは、
+            # 親メッセージのメタデータ (reply_users) だけで集計できるのでAPIを呼ばない
+            reply_users = msg.get("reply_users", [])
+            if msg["reply_count"] == msg.get("reply_users_count") == len(reply_users):
+                counts.update(filter(None, map(get_email, reply_users)))
                 continue
+
+            # それ以外は後でまとめて取得
+            threaded.append(msg)
+
+        # --- 2. スレッド（返信）のカウント ---
+        print(f"Fetching replies for {len(threaded)} threads...")
+        # 各スレッドの取得は独立したI/Oなので並列に実行し、集計はメインスレッドで行う
+        throttle = _SlackThrottle(SLACK_MIN_INTERVAL)
+        seen_reply_ts = set()  # 同じ返信を二重にカウントしないため
+        rate_limited = []  # SDK の再試行を使い切ったスレッド
+
+        def count_replies(msg, replies):
+            # 親メッセージ自体の重複カウント、集計済みの返信、Botを除外
+            parent_ts = msg["ts"]
+            new_replies = [
+                r for r in replies
+                if r["ts"] != parent_ts and r["ts"] not in seen_reply_ts and "bot_id" not in r
+            ]
+            seen_reply_ts.update(r["ts"] for r in new_replies)
+            counts.update(filter(None, (get_email(r.get("user")) for r in new_replies)))
+
+        with ThreadPoolExecutor(max_workers=SLACK_THREAD_WORKERS) as executor:
+            futures = {
+                executor.submit(
+                    _fetch_thread_replies, client, throttle,
+                    channel_id, msg["thread_ts"], oldest, latest
+                ): msg
+                for msg in threaded
+            }
             
-            # --- 1. 親メッセージのカウント ---
-            uid = msg.get("user")
-            if uid in uid_to_email:
-                email = uid_to_email[uid]
-                counts[email] = counts.get(email, 0) + 1
-
-            # --- 2. スレッド（返信）のカウント ---
-            # thread_ts があり、かつ返信数が1以上の場合
-            if "thread_ts" in msg and msg.get("reply_count", 0) > 0:
+            for i, future in enumerate(as_completed(futures)):
+                msg = futures[future]
                 try:
-                    replies_resp = client.conversations_replies(
-                        channel=channel_id,
-                        ts=msg["thread_ts"],
-                        limit=1000,
-                        oldest=oldest, # 期間内の返信のみ対象にする
-                        latest=latest
-                    )
-                    
-                    for reply in replies_resp["messages"]:
-                        # 親メッセージ自体の重複カウントを防ぐ
-                        if reply["ts"] == msg["ts"]:
-                            continue
-                        
-                        # Bot除外
-                        if "bot_id" in reply:
-                            continue
-                            
-                        r_uid = reply.get("user")
-                        if r_uid in uid_to_email:
-                            r_email = uid_to_email[r_uid]
-                            counts[r_email] = counts.get(r_email, 0) + 1
-                    
-                    # APIレート制限対策 (重要)
-                    time.sleep(0.1) 
-                    
+                    replies = future.result()
                 except SlackApiError as e:
-                    print(f"Thread fetch warning: {e}")
-                    time.sleep(1) # エラー時は少し長く待つ
+                    if e.response.status_code == 429:
+                        # 取りこぼすと集計が過少になるため、全ワーカーを待たせて後で直列に取り直す
+                        throttle.backoff(_retry_after(e))
+                        rate_limited.append(msg)
+                    else:
+                        print(f"Thread fetch warning: {e}")
                     continue
 
-            # 進捗ログ (50件ごと)
-            if (i + 1) % 50 == 0:
-                print(f"Processed {i + 1}/{len(messages)} threads...")
+                count_replies(msg, replies)
+
+                # 進捗ログ (50件ごと)
+                if (i + 1) % 50 == 0:
+                    print(f"Processed {i + 1}/{len(threaded)} threads...")
+
+        # --- 3. レート制限で取得できなかったスレッドを直列に再取得 ---
+        # それでも取得できない場合は、不完全な集計を保存しないよう実行自体を失敗させる
+        if rate_limited:
+            print(f"Retrying {len(rate_limited)} rate-limited threads serially...")
+        for msg in rate_limited:
+            try:
+                replies = _fetch_thread_replies(
+                    client, throttle, channel_id, msg["thread_ts"], oldest, latest
+                )
+            except SlackApiError as e:
+                if e.response.status_code != 429:
+                    print(f"Thread fetch warning: {e}")
+                    continue
+                raise RuntimeError(
+                    f"Slack rate limit: could not fetch thread {msg['thread_ts']}"
+                ) from e
+            count_replies(msg, replies)
 
         return pd.DataFrame(list(counts.items()), columns=["Email", "Slack Count"])
 
@@ -144,22 +306,25 @@ def fetch_linear_data(start_date):
     url = "https://api.linear.app/graphql"
     date_str = start_date.strftime("%Y-%m-%d")
     
-    # 完了かつキャンセルされていないIssueを最大100件取得
+    # 完了かつキャンセルされていないIssueを100件ずつ全ページ取得
     query = f"""
-    query {{
+    query ($cursor: String) {{
       issues(
         first: 100
+        after: $cursor
         filter: {{ 
           completedAt: {{ gte: "{date_str}" }}
           state: {{ type: {{ eq: "completed" }} }}
         }}
       ) {{
         nodes {{
-          title
           assignee {{
             email
           }}
-          completedAt
+        }}
+        pageInfo {{
+          hasNextPage
+          endCursor
         }}
       }}
     }}
@@ -168,20 +333,29 @@ def fetch_linear_data(start_date):
     headers = {"Authorization": api_key, "Content-Type": "application/json"}
     
     try:
-        response = requests.post(url, json={"query": query}, headers=headers)
-        if response.status_code != 200:
-            print(f"Linear API Error: {response.text}")
-            return pd.DataFrame(columns=["Email", "Linear Count"])
+        issues = []
+        cursor = None
+        while True:
+            response = _linear_session.post(
+                url, json={"query": query, "variables": {"cursor": cursor}}, headers=headers
+            )
+            if response.status_code != 200:
+                print(f"Linear API Error: {response.text}")
+                return pd.DataFrame(columns=["Email", "Linear Count"])
+                
+            data = response.json()
+            page = data.get("data", {}).get("issues", {})
+            issues.extend(page.get("nodes", []))
             
-        data = response.json()
-        issues = data.get("data", {}).get("issues", {}).get("nodes", [])
+            page_info = page.get("pageInfo", {})
+            if not page_info.get("hasNextPage"):
+                break
+            cursor = page_info["endCursor"]
         
-        counts = {}
-        for issue in issues:
-            assignee = issue.get("assignee")
-            if assignee and assignee.get("email"):
-                email = assignee["email"]
-                counts[email] = counts.get(email, 0) + 1
+        counts = Counter(
+            issue["assignee"]["email"] for issue in issues
+            if issue.get("assignee") and issue["assignee"].get("email")
+        )
                 
         return pd.DataFrame(list(counts.items()), columns=["Email", "Linear Count"])
 
@@ -201,15 +375,20 @@ def main():
     
     print(f"📅 Range: {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}")
 
-    # 1. データ取得
-    user_directory = fetch_slack_user_directory()
-    df_slack = fetch_slack_data(start_date, end_date)
-    df_linear = fetch_linear_data(start_date)
+    # 1. データ取得 (3つとも独立したI/Oなので並列に実行)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        f_directory = executor.submit(fetch_slack_user_directory)
+        f_slack = executor.submit(fetch_slack_data, start_date, end_date)
+        f_linear = executor.submit(fetch_linear_data, start_date)
+        user_directory = f_directory.result()
+        df_slack = f_slack.result()
+        df_linear = f_linear.result()
     
     # 2. 名寄せ
-    emails_slack = set(df_slack["Email"]) if not df_slack.empty else set()
-    emails_linear = set(df_linear["Email"]) if not df_linear.empty else set()
-    all_emails = set(user_directory.keys()) | emails_slack | emails_linear
+    # Email -> 件数 の辞書に一度だけ変換し、ループ内でのDataFrame絞り込みを避ける
+    slack_counts = dict(zip(df_slack["Email"], df_slack["Slack Count"]))
+    linear_counts = dict(zip(df_linear["Email"], df_linear["Linear Count"]))
+    all_emails = set(user_directory.keys()) | slack_counts.keys() | linear_counts.keys()
     
     rows = []
     for email in all_emails:
@@ -219,27 +398,13 @@ def main():
             "Avatar": ""
         })
         
-        # Slack Count
-        slack_count = 0
-        if not df_slack.empty:
-            s_row = df_slack[df_slack["Email"] == email]
-            if not s_row.empty:
-                slack_count = s_row["Slack Count"].sum()
-        
-        # Linear Count
-        linear_count = 0
-        if not df_linear.empty:
-            l_row = df_linear[df_linear["Email"] == email]
-            if not l_row.empty:
-                linear_count = l_row["Linear Count"].sum()
-        
         rows.append({
             "Email": email,
             "User": profile["User Name"],
             "Role": profile["Role"],
             "Avatar": profile["Avatar"],
-            "Slack Count": int(slack_count),
-            "Linear Count": int(linear_count),
+            "Slack Count": int(slack_counts.get(email, 0)),
+            "Linear Count": int(linear_counts.get(email, 0)),
             "Working Hours": 40 if profile["Role"] == "Employee" else 20
         })
     
@@ -250,8 +415,10 @@ def main():
     df_merged = pd.DataFrame(rows)
     
     os.makedirs("data", exist_ok=True)
-    output_path = "data/engagement.csv"
-    df_merged.to_csv(output_path, index=False)
+    # アプリはParquetを読み込む (型情報付き・高速)。CSVは差分確認用に残す
+    output_path = "data/engagement.parquet"
+    df_merged.to_parquet(output_path, engine="pyarrow", compression="snappy", index=False)
+    df_merged.to_csv("data/engagement.csv", index=False)
     print(f"✅ Saved to {output_path}")
     print(df_merged.head())
 